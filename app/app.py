@@ -1,51 +1,283 @@
+import asyncio
+import contextlib
+import functools
+import ipaddress
 import os
 import secrets
-import urllib.request
-from typing import Any, Optional
-
-import aiofiles
-import filetype
+import socket
+import threading
+from collections.abc import AsyncIterator, Iterator
+from typing import BinaryIO, Callable, Optional, Union
+from urllib.parse import urlsplit
+
+import cache
+import httpx
 import imgpush
 import settings
-import video
-from fastapi import FastAPI, File, Header, HTTPException, Query, Request, UploadFile
+from fastapi import Depends, FastAPI, File, Header, HTTPException, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response
+from limits import RateLimitItem
 from limits import parse as parse_limit
 from limits.storage import MemoryStorage
-from limits.strategies import FixedWindowRateLimiter
-from slowapi import Limiter
-from slowapi.errors import RateLimitExceeded
+from limits.strategies import MovingWindowRateLimiter
 from slowapi.util import get_remote_address
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Shared client for fetching uploads by URL. Redirects are not followed, as they could lead to an internal host
+_http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(10.0, read=60.0),
+    limits=httpx.Limits(max_connections=32),
+    follow_redirects=False,
+)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    yield
+    await _http_client.aclose()
 
-app = FastAPI(openapi_url=None)
 
-# Rate limiter
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
+app = FastAPI(openapi_url=None, lifespan=lifespan)
 
-# Rate limiter for failed API key attempts
-_auth_limiter = FixedWindowRateLimiter(MemoryStorage())
+# Rate limiter for uploads, see upload_limits()
+_upload_limiter = MovingWindowRateLimiter(MemoryStorage())
+
+# Rate limiter for failed API key attempts, a moving window so attempts can't burst across window boundaries
+_auth_limiter = MovingWindowRateLimiter(MemoryStorage())
 _failed_auth_limit = parse_limit(f"{settings.MAX_API_KEY_ATTEMPTS_PER_MINUTE}/minute")
 
+_BEARER_PREFIX = b"Bearer "
+
+# LRU index bounding the size of CACHE_DIR, see get_cache_index()
+_cache_index: Optional[cache.CacheIndex] = None
+_cache_index_lock = threading.Lock()
+
+# One lock per resized image being generated, so concurrent requests for it resize only once
+_resize_locks: dict[str, asyncio.Lock] = {}
+
+# Uploads are copied to disk in chunks of this size so memory use stays flat
+_CHUNK_SIZE = 1024 * 1024
+
+# Number of leading bytes kept for imgpush.guess_extension, enough to find the <svg tag after an XML prolog
+_SNIFF_SIZE = 4096
+
+
+def _passes(filepath: str) -> bool:
+    return False
+
+
+# Checks for features that are disabled in settings are bound to a no-op once at import.
+# Video uploads are gated on the same import-time value, so turning ALLOW_VIDEO on later can't let videos in unchecked.
+_ALLOW_VIDEO = settings.ALLOW_VIDEO
+_check_nudity: Callable[[str], bool] = imgpush.check_nudity_filter if settings.NUDE_FILTER_MAX_THRESHOLD else _passes
+_check_video_duration: Callable[[str], bool] = _passes
+_check_video_nudity: Callable[[str], bool] = _passes
+if _ALLOW_VIDEO:
+    import video
+
+    _check_video_duration = video.check_video_duration
+    if settings.NUDE_FILTER_MAX_THRESHOLD:
+        _check_video_nudity = video.check_video_nudity_filter
+
 
 def check_auth(request: Request, authorization: Optional[str]) -> None:
     """Validate Bearer token authentication with rate limiting on failures."""
-    if not authorization or not authorization.startswith("Bearer "):
+    raw = authorization.encode() if authorization else b""
+    if not secrets.compare_digest(raw[: len(_BEARER_PREFIX)], _BEARER_PREFIX):
         raise HTTPException(status_code=403, detail="Authorization required")
 
-    token = authorization[7:]
-    if settings.API_KEY is None or not secrets.compare_digest(token, settings.API_KEY):
+    token = raw[len(_BEARER_PREFIX) :]
+    if settings.API_KEY is None or not secrets.compare_digest(token, settings.API_KEY.encode()):
         client_ip = get_remote_address(request)
         if not _auth_limiter.hit(_failed_auth_limit, client_ip):
             raise HTTPException(status_code=429, detail="Too many failed attempts")
         raise HTTPException(status_code=403, detail="Invalid API key")
 
 
-@app.exception_handler(RateLimitExceeded)
-async def rate_limit_handler(request: Request, exc: RateLimitExceeded) -> JSONResponse:
-    return JSONResponse(content={"detail": "Rate limit exceeded"}, status_code=429)
+@functools.lru_cache(maxsize=4)
+def upload_limits(per_day: int, per_hour: int, per_minute: int) -> tuple[RateLimitItem, ...]:
+    return (
+        parse_limit(f"{per_day}/day"),
+        parse_limit(f"{per_hour}/hour"),
+        parse_limit(f"{per_minute}/minute"),
+    )
+
+
+async def rate_limit_upload(request: Request) -> None:
+    # Settings are read per request so changed limits apply without a restart, parsing is cached
+    limits = upload_limits(settings.MAX_UPLOADS_PER_DAY, settings.MAX_UPLOADS_PER_HOUR, settings.MAX_UPLOADS_PER_MINUTE)
+    client_ip = get_remote_address(request)
+    for limit in limits:
+        if not _upload_limiter.hit(limit, client_ip):
+            raise HTTPException(status_code=429, detail="Rate limit exceeded")
+
+
+@contextlib.contextmanager
+def open_upload_file(filepath: str) -> Iterator[BinaryIO]:
+    """Open filepath for writing, removing it again if writing fails."""
+    try:
+        with open(filepath, "wb", buffering=_CHUNK_SIZE) as f:
+            yield f
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(filepath)
+        raise
+
+
+def check_upload_size(size: int) -> None:
+    if size > settings.MAX_SIZE_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+
+def copy_upload(src: BinaryIO, filepath: str) -> bytes:
+    """Copy an uploaded file to filepath. Blocking, meant to run in a worker thread.
+
+    Returns the leading bytes of the file, for sniffing its type without reading it back.
+    """
+    size = 0
+    head = b""
+    with open_upload_file(filepath) as dst:
+        while chunk := src.read(_CHUNK_SIZE):
+            size += len(chunk)
+            check_upload_size(size)
+            if len(head) < _SNIFF_SIZE:
+                head += chunk[: _SNIFF_SIZE - len(head)]
+            dst.write(chunk)
+    return head
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def check_download_url(url: str) -> str:
+    """Reject URLs that are not http(s), not in ALLOWED_URL_HOSTS or that resolve to a non-public address.
+
+    Returns the checked address, download_url connects to it instead of resolving the host again.
+    """
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        # Unbalanced IPv6 brackets or a port out of range
+        raise HTTPException(status_code=400, detail="Invalid URL")
+    if parts.scheme not in ("http", "https") or not host:
+        raise HTTPException(status_code=400, detail="Invalid URL")
+    if settings.ALLOWED_URL_HOSTS and host not in (allowed.lower() for allowed in settings.ALLOWED_URL_HOSTS):
+        raise HTTPException(status_code=400, detail="URL host is not allowed")
+
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (ValueError, OSError):
+        raise HTTPException(status_code=400, detail="File is missing!")
+    if not addresses or not all(is_public_address(str(sockaddr[0])) for *_, sockaddr in addresses):
+        raise HTTPException(status_code=400, detail="URL host is not allowed")
+    return str(addresses[0][4][0])
+
+
+async def download_url(url: str, filepath: str, address: str) -> bytes:
+    """Download url to filepath from address, as returned by check_download_url.
+
+    Returns the leading bytes of the file, like copy_upload.
+    """
+    # Resolving the host again would let a short-lived DNS record swap in an internal address after the check.
+    # The connection goes to the checked address, with the original host in the Host header and for TLS.
+    parsed = httpx.URL(url)
+    request = _http_client.build_request(
+        "GET",
+        parsed.copy_with(host=address),
+        headers={"Host": parsed.netloc.decode("ascii")},
+        extensions={"sni_hostname": parsed.raw_host.decode("ascii")},
+    )
+    size = 0
+    head = b""
+    async with contextlib.aclosing(await _http_client.send(request, stream=True)) as response:
+        response.raise_for_status()
+        with open_upload_file(filepath) as dst:
+            async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                size += len(chunk)
+                check_upload_size(size)
+                if len(head) < _SNIFF_SIZE:
+                    head += chunk[: _SNIFF_SIZE - len(head)]
+                await asyncio.to_thread(dst.write, chunk)
+    return head
+
+
+class PathsendFileResponse(FileResponse):
+    """FileResponse that hands the path to the server when it supports the ASGI pathsend extension.
+
+    The server can then send the file with sendfile() instead of reading it through Python.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            "http.response.pathsend" not in scope.get("extensions", {})
+            or scope["method"] == "HEAD"
+            or "range" in Headers(scope=scope)
+        ):
+            await super().__call__(scope, receive, send)
+            return
+
+        if self.stat_result is None:
+            self.set_stat_headers(await asyncio.to_thread(os.stat, self.path))
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await send({"type": "http.response.pathsend", "path": os.fspath(self.path)})
+
+
+def resolve_file(root: str, filename: str) -> tuple[str, bool]:
+    """Resolve filename inside root and check that it is a file. Blocking, meant to run in a worker thread."""
+    path = imgpush.safe_join(root, filename)
+    return path, os.path.isfile(path)
+
+
+def get_cache_index() -> Optional[cache.CacheIndex]:
+    """Return the LRU index for CACHE_DIR, or None if MAX_CACHE_DIR_BYTES leaves the cache unbounded."""
+    global _cache_index
+    if not settings.MAX_CACHE_DIR_BYTES:
+        return None
+    # Called from worker threads
+    with _cache_index_lock:
+        if (
+            _cache_index is None
+            or _cache_index.directory != settings.CACHE_DIR
+            or _cache_index.max_bytes != settings.MAX_CACHE_DIR_BYTES
+        ):
+            _cache_index = cache.CacheIndex(settings.CACHE_DIR, settings.MAX_CACHE_DIR_BYTES)
+        return _cache_index
+
+
+def resolve_cached_file(resized_filename: str) -> tuple[str, bool]:
+    """Like resolve_file for CACHE_DIR, also marking a cache hit as recently used."""
+    path, exists = resolve_file(settings.CACHE_DIR, resized_filename)
+    cache_index = get_cache_index()
+    if exists and cache_index is not None:
+        cache_index.touch(path)
+    return path, exists
+
+
+def store_resized_image(path: str, resized_path: str, width: Union[int, str], height: Union[int, str]) -> None:
+    """Save a resized image to the cache, evicting old entries if it grows past MAX_CACHE_DIR_BYTES."""
+    imgpush.save_resized_image(path, resized_path, width, height)
+    cache_index = get_cache_index()
+    if cache_index is not None:
+        cache_index.add(resized_path)
+
+
+def send_file(request: Request, path: str) -> Response:
+    """Serve the file at path.
+
+    When nginx announces X-Accel-Redirect support via the X-Sendfile-Type request header,
+    only the X-Sendfile header is returned and nginx sends the file itself.
+    """
+    if request.headers.get("X-Sendfile-Type") == "X-Accel-Redirect":
+        return Response(headers={"X-Sendfile": path})
+    return PathsendFileResponse(path, headers={"X-Sendfile": path})
 
 
 @app.exception_handler(Exception)
@@ -62,95 +294,130 @@ app.add_middleware(
 )
 
 
-class HeaderMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next: Any) -> Response:
-        response: Response = await call_next(request)
-        x_sendfile = response.headers.get("X-Sendfile")
-        if x_sendfile:
-            response.headers["X-Accel-Redirect"] = "/nginx/" + x_sendfile
-            del response.headers["X-Sendfile"]
-        response.headers["Referrer-Policy"] = "no-referrer-when-downgrade"
-        return response
+class HeaderMiddleware:
+    """Rewrite X-Sendfile to nginx's X-Accel-Redirect and set Referrer-Policy.
+
+    Plain ASGI middleware: only the response start message is rewritten, bodies pass through untouched.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers: list[tuple[bytes, bytes]] = []
+                for name, value in message.get("headers", ()):
+                    if name == b"x-sendfile":
+                        headers.append((b"x-accel-redirect", b"/nginx/" + value))
+                    elif name != b"referrer-policy":
+                        headers.append((name, value))
+                headers.append((b"referrer-policy", b"no-referrer-when-downgrade"))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
 
 
 app.add_middleware(HeaderMiddleware)
 
 
-@app.get("/", response_class=HTMLResponse)
-def root() -> str:
-    if settings.HIDE_UPLOAD_FORM:
-        return ""
-    return """
+class StaticResponse(Response):
+    """Response built once at import and sent as is for every request.
+
+    Each send gets a copy of the headers, since middleware such as CORSMiddleware extends them in place.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": list(self.raw_headers)})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+_UPLOAD_FORM_RESPONSE = StaticResponse(
+    """
 <form action="/" method="post" enctype="multipart/form-data">
     <input type="file" name="file" id="file">
     <input type="submit" value="Upload" name="submit">
 </form>
-"""
+""",
+    media_type="text/html",
+)
+_EMPTY_RESPONSE = StaticResponse("", media_type="text/html")
+_LIVENESS_RESPONSE = StaticResponse(b'{"status":"ok"}', media_type="application/json")
+
+
+@app.get("/", response_class=HTMLResponse)
+async def root() -> Response:
+    return _EMPTY_RESPONSE if settings.HIDE_UPLOAD_FORM else _UPLOAD_FORM_RESPONSE
 
 
 @app.get("/liveness")
-def liveness() -> dict[str, str]:
-    return {"status": "ok"}
+async def liveness() -> Response:
+    return _LIVENESS_RESPONSE
 
 
-@app.post("/")
-@limiter.limit(
-    f"{settings.MAX_UPLOADS_PER_DAY}/day;{settings.MAX_UPLOADS_PER_HOUR}/hour;{settings.MAX_UPLOADS_PER_MINUTE}/minute"
-)
+@app.post("/", dependencies=[Depends(rate_limit_upload)])
 async def upload_image(
     request: Request,
     file: Optional[UploadFile] = File(default=None),
     authorization: Optional[str] = Header(default=None),
-) -> dict[str, str]:
+) -> Response:
     if settings.API_KEY and settings.REQUIRE_API_KEY_FOR_UPLOAD:
         check_auth(request, authorization)
 
     imgpush.clear_imagemagick_temp_files()
 
-    is_svg = False
-
     random_string = imgpush.get_random_filename()
     tmp_filepath = os.path.join("/tmp", random_string)
 
     if file is not None and file.filename:
-        is_svg = file.filename.endswith(".svg")
-        async with aiofiles.open(tmp_filepath, "wb") as f:
-            content = await file.read()
-            await f.write(content)
+        # Reject videos before spending a disk write on them
+        if not _ALLOW_VIDEO and imgpush.guess_extension(await file.read(_SNIFF_SIZE)) == "mp4":
+            raise HTTPException(status_code=400, detail="Video uploads are not allowed")
+        await file.seek(0)
+        head = await asyncio.to_thread(copy_upload, file.file, tmp_filepath)
     else:
         # Check for JSON body with URL
         try:
             body = await request.json()
-            if "url" in body:
-                urllib.request.urlretrieve(body["url"], tmp_filepath)
-            else:
-                raise HTTPException(status_code=400, detail="File is missing!")
+            url = str(body["url"])
         except Exception:
             raise HTTPException(status_code=400, detail="File is missing!")
+        address = await check_download_url(url)
+        try:
+            head = await download_url(url, tmp_filepath, address)
+        except (httpx.HTTPError, httpx.InvalidURL):
+            raise HTTPException(status_code=400, detail="File is missing!")
 
-    if imgpush.check_nudity_filter(tmp_filepath):
-        os.remove(tmp_filepath)
-        raise HTTPException(status_code=400, detail="Nudity not allowed")
-
-    file_filetype = filetype.guess_extension(tmp_filepath)
+    file_filetype = imgpush.guess_extension(head)
+    is_svg = file_filetype == "svg"
     output_type = (settings.OUTPUT_TYPE or file_filetype or "").replace(".", "")
 
-    if file_filetype == "mp4":
-        if not settings.ALLOW_VIDEO:
-            os.remove(tmp_filepath)
-            raise HTTPException(status_code=400, detail="Video uploads are not allowed")
-        output_type = file_filetype
-        if video.check_video_duration(tmp_filepath):
-            os.remove(tmp_filepath)
-            raise HTTPException(
-                status_code=400,
-                detail=f"Video exceeds maximum duration of {settings.MAX_VIDEO_DURATION} seconds",
-            )
-        if video.check_video_nudity_filter(tmp_filepath):
-            os.remove(tmp_filepath)
+    try:
+        if file_filetype == "mp4":
+            if not _ALLOW_VIDEO:
+                raise HTTPException(status_code=400, detail="Video uploads are not allowed")
+            output_type = file_filetype
+            if _check_video_duration(tmp_filepath):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Video exceeds maximum duration of {settings.MAX_VIDEO_DURATION} seconds",
+                )
+            if _check_video_nudity(tmp_filepath):
+                raise HTTPException(status_code=400, detail="Nudity not allowed")
+        elif _check_nudity(tmp_filepath):
             raise HTTPException(status_code=400, detail="Nudity not allowed")
-    elif is_svg:
-        output_type = "svg"
+        elif is_svg:
+            output_type = "svg"
+    except BaseException:
+        # Rejected or failed checks, process_image takes care of the temp file otherwise
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_filepath)
+        raise
 
     output_filename = os.path.basename(tmp_filepath) + f".{output_type}"
     output_path = os.path.join(settings.IMAGES_DIR, output_filename)
@@ -160,44 +427,53 @@ async def upload_image(
     if error:
         raise HTTPException(status_code=400, detail=error)
 
-    return {"filename": output_filename}
+    # Returning a response directly skips FastAPI's validation and jsonable_encoder pass over the return value
+    return JSONResponse({"filename": output_filename})
 
 
 @app.delete("/{filename:path}")
-def delete_image(
+async def delete_image(
     request: Request,
     filename: str,
     authorization: Optional[str] = Header(default=None),
-) -> dict[str, str]:
+) -> Response:
     if not settings.API_KEY or not settings.REQUIRE_API_KEY_FOR_DELETE:
         raise HTTPException(status_code=403, detail="Delete endpoint is disabled")
 
     check_auth(request, authorization)
 
     try:
-        cached_deleted = imgpush.delete_image(filename)
+        cached_deleted = await asyncio.to_thread(imgpush.delete_image, filename)
     except imgpush.PathTraversalError:
         raise HTTPException(status_code=400, detail="Invalid filename")
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
 
-    return {"status": "deleted", "cached_files_removed": str(cached_deleted)}
+    cache_index = get_cache_index()
+    if cache_index is not None:
+        await asyncio.to_thread(cache_index.discard, cached_deleted)
+
+    return JSONResponse({"status": "deleted", "cached_files_removed": str(len(cached_deleted))})
 
 
 @app.get("/{filename:path}")
-def get_image(
+async def get_image(
+    request: Request,
     filename: str,
     w: str = Query(default=""),
     h: str = Query(default=""),
-) -> FileResponse:
-    path = os.path.join(settings.IMAGES_DIR, filename)
+) -> Response:
+    try:
+        path, exists = await asyncio.to_thread(resolve_file, settings.IMAGES_DIR, filename)
+    except imgpush.PathTraversalError:
+        raise HTTPException(status_code=400, detail="Invalid filename")
 
-    if not os.path.isfile(path):
+    if not exists:
         raise HTTPException(status_code=404, detail="File not found")
 
     filename_without_extension, extension = os.path.splitext(filename)
 
-    if (w or h) and os.path.isfile(path) and extension not in (".mp4", ".svg"):
+    if (w or h) and extension not in (".mp4", ".svg"):
         try:
             width = imgpush.get_size_from_string(w)
             height = imgpush.get_size_from_string(h)
@@ -210,16 +486,21 @@ def get_image(
         dimensions = f"{width}x{height}"
         resized_filename = filename_without_extension + f"_{dimensions}{extension}"
 
-        resized_path = os.path.join(settings.CACHE_DIR, resized_filename)
+        try:
+            resized_path, resized_exists = await asyncio.to_thread(resolve_cached_file, resized_filename)
+        except imgpush.PathTraversalError:
+            raise HTTPException(status_code=400, detail="Invalid filename")
 
-        if not os.path.isfile(resized_path) and (width or height):
-            imgpush.clear_imagemagick_temp_files()
-            resized_image = imgpush.resize_image(path, width, height)
+        if not resized_exists and (width or height):
+            lock = _resize_locks.setdefault(resized_path, asyncio.Lock())
             try:
-                resized_image.strip()
-                resized_image.save(filename=resized_path)
+                async with lock:
+                    # Another request may have created the file while this one was waiting
+                    if not await asyncio.to_thread(os.path.isfile, resized_path):
+                        await asyncio.to_thread(store_resized_image, path, resized_path, width, height)
             finally:
-                resized_image.close()
-        return FileResponse(resized_path, headers={"X-Sendfile": resized_path})
+                if _resize_locks.get(resized_path) is lock:
+                    del _resize_locks[resized_path]
+        return send_file(request, resized_path)
 
-    return FileResponse(path, headers={"X-Sendfile": path})
+    return send_file(request, path)
@@ -0,0 +1,122 @@
+import contextlib
+import fcntl
+import os
+import time
+from collections.abc import Iterator
+from typing import Optional
+
+# Total size of the cached files, shared by all worker processes using the directory
+COUNTER_FILENAME = ".cache-size"
+
+# Eviction removes files until the cache is this far below its limit, so directory scans are spread over many writes
+_EVICT_TO = 0.9
+
+# Cache hits only update a file's access time once in this many seconds, to avoid an inode write per request
+_TOUCH_INTERVAL = 60.0
+
+
+class CacheIndex:
+    """Least recently used size limit for a cache directory shared by several processes.
+
+    The total size of the cached files is kept in a counter file in the directory, updated under an
+    exclusive flock by every process, so the limit holds across all workers. Once the total exceeds
+    max_bytes the directory is scanned and files are evicted, oldest access or modification time first.
+    All methods are blocking, call them from worker threads.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @contextlib.contextmanager
+    def _locked_counter(self) -> Iterator[int]:
+        fd = os.open(os.path.join(self.directory, COUNTER_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Released when the descriptor is closed
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        found: list[tuple[float, str, int]] = []
+        with contextlib.suppress(FileNotFoundError), os.scandir(self.directory) as entries:
+            for entry in entries:
+                # Skip the counter and files that are still being written
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((max(stat.st_atime, stat.st_mtime), entry.path, stat.st_size))
+        found.sort()
+        return found
+
+    def _read_total(self, fd: int) -> Optional[int]:
+        """Read the counter, None if it is new, dropped or unreadable and the directory has to be counted."""
+        try:
+            return int(os.pread(fd, 32, 0))
+        except ValueError:
+            return None
+
+    def _write_total(self, fd: int, total: int) -> None:
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(total).encode(), 0)
+
+    def _evict(self) -> tuple[int, list[str]]:
+        found = self._scan()
+        total = sum(size for _, _, size in found)
+        evicted: list[str] = []
+        # The most recently used file is always kept, it may be about to be served
+        for _, path, size in found[:-1]:
+            if total <= self.max_bytes * _EVICT_TO:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
+            evicted.append(path)
+        return total, evicted
+
+    @property
+    def total_bytes(self) -> int:
+        with self._locked_counter() as fd:
+            total = self._read_total(fd)
+            if total is None:
+                total = sum(size for _, _, size in self._scan())
+                self._write_total(fd, total)
+            return total
+
+    def touch(self, path: str) -> None:
+        """Mark path as recently used by updating its access time, which filesystems mounted with noatime skip."""
+        now = time.time()
+        with contextlib.suppress(FileNotFoundError):
+            stat = os.stat(path)
+            if now - stat.st_atime > _TOUCH_INTERVAL:
+                os.utime(path, (now, stat.st_mtime))
+
+    def add(self, path: str) -> list[str]:
+        """Record a newly written file and evict old files if the cache is over its limit.
+
+        Returns the paths of the evicted files.
+        """
+        size = os.path.getsize(path)
+        with self._locked_counter() as fd:
+            total = self._read_total(fd)
+            # A directory count already includes the new file
+            total = sum(size for _, _, size in self._scan()) if total is None else total + size
+            evicted: list[str] = []
+            if total > self.max_bytes:
+                total, evicted = self._evict()
+            self._write_total(fd, total)
+            return evicted
+
+    def discard(self, paths: list[str]) -> None:
+        """Account for files that were removed from the cache directory.
+
+        Their sizes are gone with them, so the total is recounted from the directory on next use.
+        """
+        if not paths:
+            return
+        with self._locked_counter() as fd:
+            os.ftruncate(fd, 0)
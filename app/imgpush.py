@@ -1,23 +1,99 @@
+import contextlib
 import datetime
+import functools
 import glob
 import os
-import random
 import shutil
 import string
 import time
 import uuid
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
 import settings
 from wand.exceptions import MissingDelegateError
 from wand.image import Image
 
-if settings.NUDE_FILTER_MAX_THRESHOLD:
+if TYPE_CHECKING:
     from nudenet import NudeClassifier
 
-    nude_classifier = NudeClassifier()
-else:
-    nude_classifier = None
+
+def _load_classifier() -> "NudeClassifier":
+    """Load nudenet's classifier, on the GPU when onnxruntime-gpu is installed, and warm it up.
+
+    Runs once per worker process. entrypoint.sh restarts workers every 200 requests (--limit-max-requests),
+    so each restart pays for the model load, the TensorRT engine setup and the warm-up again.
+    """
+    import numpy
+    import onnxruntime
+    from nudenet import NudeClassifier
+
+    classifier = NudeClassifier()
+    # nudenet creates its session with the default providers, move it to the GPU when onnxruntime-gpu is installed.
+    # The CPU session NudeClassifier() already built is thrown away then, the model is loaded twice.
+    available_providers = onnxruntime.get_available_providers()
+    providers: list[Union[str, tuple[str, dict[str, object]]]] = []
+    if settings.NUDE_FILTER_TENSORRT and "TensorrtExecutionProvider" in available_providers:
+        # The input's batch dimension is dynamic. Without a profile covering every batch size the classifier gets,
+        # from single images up to NUDE_FILTER_BATCH_SIZE video frames, the engine is rebuilt mid-request.
+        model_input = classifier.nsfw_model.get_inputs()[0]
+        image_dims = "x".join(str(dim) for dim in model_input.shape[1:])
+        max_batch_size = max(settings.NUDE_FILTER_BATCH_SIZE, 1)
+        # Engines take minutes to build, cache them next to nudenet's model so only the first start pays for it
+        providers.append(
+            (
+                "TensorrtExecutionProvider",
+                {
+                    "trt_fp16_enable": True,
+                    "trt_engine_cache_enable": True,
+                    "trt_engine_cache_path": os.path.join(os.path.expanduser("~"), ".NudeNet", "trt"),
+                    "trt_profile_min_shapes": f"{model_input.name}:1x{image_dims}",
+                    "trt_profile_opt_shapes": f"{model_input.name}:{max_batch_size}x{image_dims}",
+                    "trt_profile_max_shapes": f"{model_input.name}:{max_batch_size}x{image_dims}",
+                },
+            )
+        )
+    if "CUDAExecutionProvider" in available_providers:
+        providers.append("CUDAExecutionProvider")
+    if providers:
+        classifier.nsfw_model = onnxruntime.InferenceSession(
+            os.path.join(os.path.expanduser("~"), ".NudeNet", "classifier_model.onnx"),
+            providers=[*providers, "CPUExecutionProvider"],
+        )
+
+    # Inference on black frames at startup, so session optimization and kernel setup don't land on the first upload.
+    # Both batch sizes uploads use are run: single images and full batches of video frames.
+    with contextlib.suppress(Exception):
+        black_frame = numpy.zeros((256, 256, 3), dtype=numpy.uint8)
+        for batch_size in sorted({1, max(settings.NUDE_FILTER_BATCH_SIZE, 1)}):
+            classifier.classify([black_frame] * batch_size, batch_size=batch_size)
+    return classifier
+
+
+nude_classifier: Optional["NudeClassifier"] = _load_classifier() if settings.NUDE_FILTER_MAX_THRESHOLD else None
+
+
+RANDOMSTR_ALPHABET = string.ascii_lowercase + string.digits + string.ascii_uppercase
+
+# Major brands of the ISO base media file formats we recognize, from the ftyp box at offset 4
+HEIC_BRANDS = frozenset((b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1"))
+AVIF_BRANDS = frozenset((b"avif", b"avis"))
+MP4_BRANDS = frozenset(
+    (
+        b"mp41",
+        b"mp42",
+        b"isom",
+        b"iso2",
+        b"iso4",
+        b"iso5",
+        b"iso6",
+        b"avc1",
+        b"dash",
+        b"M4V ",
+        b"mmp4",
+        b"3gp4",
+        b"3gp5",
+    )
+)
 
 
 class InvalidSizeError(Exception):
@@ -32,10 +108,42 @@ class PathTraversalError(Exception):
     pass
 
 
+def guess_extension(head: bytes) -> Optional[str]:
+    """Guess the file extension from the leading bytes of a file, or None if the format isn't supported."""
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if head[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in HEIC_BRANDS:
+            return "heic"
+        if brand in AVIF_BRANDS:
+            return "avif"
+        if brand in MP4_BRANDS:
+            return "mp4"
+        return None
+    if head[:2] == b"BM":
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tif"
+    if head[:4] == b"\x00\x00\x01\x00":
+        return "ico"
+    if head[:4] == b"8BPS":
+        return "psd"
+    if head.lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"<" and b"<svg" in head:
+        return "svg"
+    return None
+
+
 def get_size_from_string(size: str) -> Union[int, str]:
     try:
         size_int = int(size)
-        if len(settings.VALID_SIZES) and size_int not in settings.VALID_SIZES:
+        if settings.VALID_SIZES_SET and size_int not in settings.VALID_SIZES_SET:
             raise InvalidSizeError
         return size_int
     except ValueError:
@@ -73,7 +181,9 @@ def generate_random_filename() -> str:
     if settings.NAME_STRATEGY == "uuidv4":
         return str(uuid.uuid4())
     elif settings.NAME_STRATEGY == "randomstr":
-        return "".join(random.choices(string.ascii_lowercase + string.digits + string.ascii_uppercase, k=5))
+        # 64 random bits spread over 5 base62 digits leave no measurable modulo bias
+        n = int.from_bytes(os.urandom(8), "big")
+        return "".join(RANDOMSTR_ALPHABET[(n // 62**i) % 62] for i in range(5))
     return ""
 
 
@@ -136,6 +246,29 @@ def resize_image(path: str, width: Union[int, str], height: Union[int, str]) ->
         raise
 
 
+def save_resized_image(path: str, resized_path: str, width: Union[int, str], height: Union[int, str]) -> None:
+    """Resize the image at path and save it to resized_path.
+
+    The image is written to a temporary file next to resized_path and renamed into place,
+    so concurrent readers never see a partially written file.
+    """
+    clear_imagemagick_temp_files()
+    resized_image = resize_image(path, width, height)
+    directory, name = os.path.split(resized_path)
+    # Keep the extension last so ImageMagick still picks the output format from it
+    tmp_path = os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{name}")
+    try:
+        resized_image.strip()
+        resized_image.save(filename=tmp_path)
+        os.replace(tmp_path, resized_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    finally:
+        resized_image.close()
+
+
 def check_nudity_filter(filepath: str) -> bool:
     """Check if image passes nudity filter"""
     if settings.NUDE_FILTER_MAX_THRESHOLD and nude_classifier is not None:
@@ -144,18 +277,33 @@ def check_nudity_filter(filepath: str) -> bool:
     return False
 
 
-def delete_image(filename: str) -> int:
+@functools.lru_cache(maxsize=8)
+def _realpath(path: str) -> str:
+    return os.path.realpath(path)
+
+
+def safe_join(root: str, filename: str) -> str:
+    """Resolve filename inside root.
+
+    Raises PathTraversalError if the resolved path is not below root or filename can't be a path, e.g. contains NUL.
+    """
+    real_root = _realpath(root)
+    try:
+        path = os.path.realpath(os.path.join(real_root, filename))
+    except ValueError:
+        raise PathTraversalError("Invalid filename")
+    if path == real_root or os.path.commonpath([real_root, path]) != real_root:
+        raise PathTraversalError("Invalid filename")
+    return path
+
+
+def delete_image(filename: str) -> list[str]:
     """Delete an image and all its cached resized versions.
 
-    Returns the number of cached files deleted.
+    Returns the paths of the cached files deleted.
     Raises PathTraversalError if filename attempts directory traversal.
     """
-    # Sanitize filename to prevent path traversal
-    image_path = os.path.realpath(os.path.join(settings.IMAGES_DIR, filename))
-    images_dir = os.path.realpath(settings.IMAGES_DIR)
-
-    if not image_path.startswith(images_dir + os.sep):
-        raise PathTraversalError("Invalid filename")
+    image_path = safe_join(settings.IMAGES_DIR, filename)
 
     if not os.path.isfile(image_path):
         raise FileNotFoundError(f"Image {filename} not found")
@@ -171,7 +319,7 @@ def delete_image(filename: str) -> int:
     for cached_file in cached_files:
         os.remove(cached_file)
 
-    return len(cached_files)
+    return cached_files
 
 
 def process_image(tmp_filepath: str, output_path: str, output_type: str, is_svg: bool = False) -> Optional[str]:
@@ -205,7 +353,8 @@ def process_image(tmp_filepath: str, output_path: str, output_type: str, is_svg:
     except MissingDelegateError:
         error = "Invalid Filetype"
     finally:
-        if os.path.exists(tmp_filepath):
-            os.remove(tmp_filepath)
+        # The temp file is already gone when it was moved into IMAGES_DIR
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_filepath)
 
     return error
@@ -1,21 +1,26 @@
-import contextlib
+import ast
 import os
-from typing import Optional
+from typing import Any, Callable, Optional
 
 IMAGES_DIR: str = "/images/"
 CACHE_DIR: str = "/cache/"
+MAX_CACHE_DIR_BYTES: int = 0
 OUTPUT_TYPE: Optional[str] = None
 MAX_UPLOADS_PER_DAY: int = 1000
 MAX_UPLOADS_PER_HOUR: int = 100
 MAX_UPLOADS_PER_MINUTE: int = 20
 ALLOWED_ORIGINS: list[str] = ["*"]
+ALLOWED_URL_HOSTS: list[str] = []
 NAME_STRATEGY: str = "randomstr"
 MAX_TMP_FILE_AGE: int = 5 * 60
 RESIZE_TIMEOUT: int = 5
 NUDE_FILTER_MAX_THRESHOLD: Optional[float] = None
 NUDE_FILTER_VIDEO_INTERVAL: float = 1.0
 NUDE_FILTER_MAX_FRAMES: int = 5
+NUDE_FILTER_BATCH_SIZE: int = 8
+NUDE_FILTER_TENSORRT: bool = False
 ALLOW_VIDEO: bool = False
+VIDEO_HW_ACCELERATION: bool = False
 MAX_VIDEO_DURATION: float = 60.0
 HIDE_UPLOAD_FORM: bool = False
 API_KEY: Optional[str] = None
@@ -27,10 +32,76 @@ VALID_SIZES: list[int] = []
 
 MAX_SIZE_MB: int = 16
 
-for variable in [item for item in globals() if not item.startswith("__")]:
-    NULL = "NULL"
-    env_var = os.getenv(variable, NULL).strip()
-    if env_var is not NULL:
-        with contextlib.suppress(Exception):
-            env_var = eval(env_var)
-    globals()[variable] = env_var if env_var is not NULL else globals()[variable]
+
+def _parse_bool(value: str) -> bool:
+    # Anything else is a typo, which must not quietly turn a setting such as REQUIRE_API_KEY_FOR_UPLOAD off
+    value = value.lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("", "0", "false", "no", "off"):
+        return False
+    raise ValueError(f"Not a boolean: {value!r}")
+
+
+def _parse_optional(parse: Callable[[str], object]) -> Callable[[str], object]:
+    def parse_optional(value: str) -> object:
+        if value.lower() in ("", "none", "null"):
+            return None
+        return parse(value)
+
+    return parse_optional
+
+
+def _parse_list(item_type: Callable[[Any], object]) -> Callable[[str], object]:
+    def parse_list(value: str) -> object:
+        # literal_eval only accepts literals, so values like "['https://a.com']" keep working without eval()
+        try:
+            parsed: Any = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            parsed = [item.strip() for item in value.split(",") if item.strip()]
+        items: list[Any] = [parsed] if isinstance(parsed, (str, int, float)) else list(parsed)
+        return [item_type(item) for item in items]
+
+    return parse_list
+
+
+_PARSERS: dict[str, Callable[[str], object]] = {
+    "IMAGES_DIR": str,
+    "CACHE_DIR": str,
+    "MAX_CACHE_DIR_BYTES": int,
+    "OUTPUT_TYPE": _parse_optional(str),
+    "MAX_UPLOADS_PER_DAY": int,
+    "MAX_UPLOADS_PER_HOUR": int,
+    "MAX_UPLOADS_PER_MINUTE": int,
+    "ALLOWED_ORIGINS": _parse_list(str),
+    "ALLOWED_URL_HOSTS": _parse_list(str),
+    "NAME_STRATEGY": str,
+    "MAX_TMP_FILE_AGE": int,
+    "RESIZE_TIMEOUT": int,
+    "NUDE_FILTER_MAX_THRESHOLD": _parse_optional(float),
+    "NUDE_FILTER_VIDEO_INTERVAL": float,
+    "NUDE_FILTER_MAX_FRAMES": int,
+    "NUDE_FILTER_BATCH_SIZE": int,
+    "NUDE_FILTER_TENSORRT": _parse_bool,
+    "ALLOW_VIDEO": _parse_bool,
+    "VIDEO_HW_ACCELERATION": _parse_bool,
+    "MAX_VIDEO_DURATION": float,
+    "HIDE_UPLOAD_FORM": _parse_bool,
+    "API_KEY": _parse_optional(str),
+    "REQUIRE_API_KEY_FOR_UPLOAD": _parse_bool,
+    "REQUIRE_API_KEY_FOR_DELETE": _parse_bool,
+    "MAX_API_KEY_ATTEMPTS_PER_MINUTE": int,
+    "VALID_SIZES": _parse_list(int),
+    "MAX_SIZE_MB": int,
+}
+
+for variable, parse in _PARSERS.items():
+    env_var = os.getenv(variable)
+    if env_var is not None:
+        try:
+            globals()[variable] = parse(env_var.strip())
+        except (ValueError, TypeError, SyntaxError) as e:
+            raise ValueError(f"Invalid value for {variable}: {env_var!r}") from e
+
+# Set form of VALID_SIZES for constant time checks on every resize request
+VALID_SIZES_SET: frozenset[int] = frozenset(VALID_SIZES)
@@ -52,6 +52,13 @@ class TestLivenessEndpoint:
     def test_returns_200(self, client):
         response = client.get("/liveness")
         assert response.status_code == 200
+        assert response.json() == {"status": "ok"}
+
+    def test_cached_response_headers_not_duplicated(self, client):
+        # CORSMiddleware adds headers on the way out, they must not pile up on the reused response
+        for _ in range(3):
+            response = client.get("/liveness", headers={"Origin": "https://a.com"})
+            assert response.headers.get_list("access-control-allow-origin") == ["*"]
 
 
 class TestUploadEndpoint:
@@ -145,6 +152,107 @@ class TestUploadEndpoint:
         assert response.status_code == 400
         assert "File is missing" in response.json()["detail"]
 
+    def test_upload_exceeding_max_size_returns_413(self, client, temp_dirs, monkeypatch):
+        monkeypatch.setattr("settings.MAX_SIZE_MB", 0)
+
+        response = client.post("/", files={"file": ("test.png", b"too large", "image/png")})
+        assert response.status_code == 413
+        assert "too large" in response.json()["detail"]
+
+    def test_upload_rate_limited(self, client, temp_dirs, monkeypatch, reset_rate_limiter):
+        monkeypatch.setattr("settings.MAX_UPLOADS_PER_MINUTE", 1)
+
+        # The first request uses up the limit even though it carries no file
+        response = client.post("/")
+        assert response.status_code == 400
+
+        response = client.post("/")
+        assert response.status_code == 429
+        assert "Rate limit exceeded" in response.json()["detail"]
+
+    def test_upload_video_rejected_when_not_allowed(self, client, temp_dirs, monkeypatch):
+        monkeypatch.setattr("settings.ALLOW_VIDEO", False)
+
+        mp4_data = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom" + bytes(16)
+
+        response = client.post("/", files={"file": ("test.mp4", mp4_data, "video/mp4")})
+        assert response.status_code == 400
+        assert "Video uploads are not allowed" in response.json()["detail"]
+
+    def test_upload_video_rejected_when_allowed_after_import(self, client, temp_dirs, monkeypatch):
+        import app as app_module
+
+        # The video checks were bound while video was disabled, so it stays disabled
+        monkeypatch.setattr(app_module, "_ALLOW_VIDEO", False)
+        monkeypatch.setattr("settings.ALLOW_VIDEO", True)
+
+        mp4_data = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom" + bytes(16)
+
+        response = client.post("/", files={"file": ("test.mp4", mp4_data, "video/mp4")})
+        assert response.status_code == 400
+        assert "Video uploads are not allowed" in response.json()["detail"]
+
+    def test_rejected_upload_removes_temp_file(self, client, temp_dirs, monkeypatch):
+        import imgpush
+
+        import app as app_module
+
+        monkeypatch.setattr(imgpush, "get_random_filename", lambda: "rejected-upload-test")
+        monkeypatch.setattr(app_module, "_check_nudity", lambda filepath: True)
+
+        response = client.post("/", files={"file": ("test.gif", b"GIF89a" + bytes(16), "image/gif")})
+        assert response.status_code == 400
+        assert "Nudity not allowed" in response.json()["detail"]
+        assert not os.path.exists("/tmp/rejected-upload-test")
+
+    def test_upload_url_to_internal_host_rejected(self, client, temp_dirs):
+        response = client.post("/", json={"url": "http://127.0.0.1/image.png"})
+        assert response.status_code == 400
+        assert "not allowed" in response.json()["detail"]
+
+        response = client.post("/", json={"url": "http://[::ffff:169.254.169.254]/latest/meta-data/"})
+        assert response.status_code == 400
+        assert "not allowed" in response.json()["detail"]
+
+        response = client.post("/", json={"url": "http://[::1/x"})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid URL"
+
+    def test_upload_url_connects_to_checked_address(self, client, temp_dirs, monkeypatch):
+        import asyncio
+        import socket
+
+        import httpx
+
+        import app as app_module
+
+        async def getaddrinfo(loop, host, port, **kwargs):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("93.184.215.14", port))]
+
+        requests: list[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(404)
+
+        monkeypatch.setattr(asyncio.BaseEventLoop, "getaddrinfo", getaddrinfo)
+        monkeypatch.setattr(app_module, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+        response = client.post("/", json={"url": "https://images.example.com:8443/image.png"})
+        assert response.status_code == 400
+        # The host isn't resolved a second time when connecting
+        [request] = requests
+        assert request.url == "https://93.184.215.14:8443/image.png"
+        assert request.headers["Host"] == "images.example.com:8443"
+        assert request.extensions["sni_hostname"] == "images.example.com"
+
+    def test_upload_url_host_not_in_allowlist_rejected(self, client, temp_dirs, monkeypatch):
+        monkeypatch.setattr("settings.ALLOWED_URL_HOSTS", ["images.example.com"])
+
+        response = client.post("/", json={"url": "https://example.org/image.png"})
+        assert response.status_code == 400
+        assert "not allowed" in response.json()["detail"]
+
     def test_upload_svg_file(self, client, temp_dirs, monkeypatch):
         monkeypatch.setattr("settings.NUDE_FILTER_MAX_THRESHOLD", None)
 
@@ -170,19 +278,167 @@ class TestGetImageEndpoint:
         assert response.status_code == 200
         assert response.content == test_content
 
+    def test_get_image_behind_nginx_skips_body(self, client, temp_dirs):
+        test_filename = "test123.txt"
+        test_path = os.path.join(temp_dirs["images"], test_filename)
+        with open(test_path, "wb") as f:
+            f.write(b"test content")
+
+        response = client.get(f"/{test_filename}", headers={"X-Sendfile-Type": "X-Accel-Redirect"})
+        assert response.status_code == 200
+        assert response.content == b""
+        assert response.headers["X-Accel-Redirect"] == "/nginx/" + test_path
+        assert "X-Sendfile" not in response.headers
+        assert response.headers["Referrer-Policy"] == "no-referrer-when-downgrade"
+
+    def test_get_image_uses_pathsend_when_supported(self, temp_dirs):
+        import asyncio
+
+        from app import app
+
+        test_filename = "test123.txt"
+        test_path = os.path.join(temp_dirs["images"], test_filename)
+        with open(test_path, "wb") as f:
+            f.write(b"test content")
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": f"/{test_filename}",
+            "raw_path": f"/{test_filename}".encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [],
+            "client": ("127.0.0.1", 1234),
+            "server": ("testserver", 80),
+            "extensions": {"http.response.pathsend": {}},
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(app(scope, receive, send))
+
+        assert messages[0]["type"] == "http.response.start"
+        assert messages[0]["status"] == 200
+        assert (b"content-length", b"12") in messages[0]["headers"]
+        assert messages[1] == {"type": "http.response.pathsend", "path": test_path}
+
+    def test_concurrent_resizes_are_deduplicated(self, temp_dirs, monkeypatch):
+        import asyncio
+        import time
+
+        import httpx
+
+        from app import app
+
+        calls = []
+
+        def fake_save_resized_image(path, resized_path, width, height):
+            calls.append(resized_path)
+            time.sleep(0.05)
+            with open(resized_path, "wb") as f:
+                f.write(b"resized")
+
+        monkeypatch.setattr("imgpush.save_resized_image", fake_save_resized_image)
+
+        with open(os.path.join(temp_dirs["images"], "test123.png"), "wb") as f:
+            f.write(b"original")
+
+        async def fetch_concurrently():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return await asyncio.gather(*(client.get("/test123.png?w=100") for _ in range(5)))
+
+        responses = asyncio.run(fetch_concurrently())
+        assert [response.status_code for response in responses] == [200] * 5
+        assert all(response.content == b"resized" for response in responses)
+        assert len(calls) == 1
+
+    def test_get_path_traversal_blocked(self, client, temp_dirs):
+        response = client.get("/..%2F..%2F..%2Fetc/passwd")
+        assert response.status_code == 400
+        assert "Invalid filename" in response.json()["detail"]
+
+        response = client.get("/a%00b.png")
+        assert response.status_code == 400
+        assert "Invalid filename" in response.json()["detail"]
+
     def test_get_nonexistent_image_returns_404(self, client, temp_dirs):
         response = client.get("/nonexistent.png")
         assert response.status_code == 404
 
 
+class TestRandomFilename:
+    def test_randomstr_is_five_alphanumeric_chars(self, monkeypatch):
+        import imgpush
+
+        monkeypatch.setattr("settings.NAME_STRATEGY", "randomstr")
+        names = {imgpush.generate_random_filename() for _ in range(100)}
+        assert len(names) > 90
+        for name in names:
+            assert len(name) == 5
+            assert all(char in imgpush.RANDOMSTR_ALPHABET for char in name)
+
+    def test_uuidv4(self, monkeypatch):
+        import uuid
+
+        import imgpush
+
+        monkeypatch.setattr("settings.NAME_STRATEGY", "uuidv4")
+        assert uuid.UUID(imgpush.generate_random_filename()).version == 4
+
+
+class TestGuessExtension:
+    @pytest.mark.parametrize(
+        ("head", "extension"),
+        [
+            (b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR", "png"),
+            (b"\xff\xd8\xff\xe0\x00\x10JFIF", "jpg"),
+            (b"GIF89a\x01\x00\x01\x00", "gif"),
+            (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "webp"),
+            (b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom", "mp4"),
+            (b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00", "heic"),
+            (b"\x00\x00\x00\x1cftypavif\x00\x00\x00\x00", "avif"),
+            (b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg"></svg>', "svg"),
+            (b"<?xml version='1.0'?><note></note>", None),
+            (b"\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00", None),
+            (b"not an image", None),
+            (b"", None),
+        ],
+    )
+    def test_guess_extension(self, head, extension):
+        import imgpush
+
+        assert imgpush.guess_extension(head) == extension
+
+    def test_svg_detected_regardless_of_filename(self, client, temp_dirs, monkeypatch):
+        monkeypatch.setattr("settings.NUDE_FILTER_MAX_THRESHOLD", None)
+
+        svg_data = b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"></svg>'
+
+        response = client.post("/", files={"file": ("image.png", svg_data, "image/png")})
+        assert response.status_code == 200
+        assert response.json()["filename"].endswith(".svg")
+
+
 @pytest.fixture
 def reset_rate_limiter():
     """Reset the rate limiter storage between tests."""
-    from app import _auth_limiter
+    from app import _auth_limiter, _upload_limiter
 
     _auth_limiter.storage.reset()
+    _upload_limiter.storage.reset()
     yield
     _auth_limiter.storage.reset()
+    _upload_limiter.storage.reset()
 
 
 @pytest.fixture
@@ -224,6 +480,11 @@ class TestDeleteEndpoint:
         assert response.status_code == 403
         assert "Authorization required" in response.json()["detail"]
 
+    def test_delete_non_ascii_api_key(self, client, temp_dirs, enable_api_key):
+        response = client.delete("/test.png", headers={"Authorization": "Bearer t\u00e9st-key".encode("latin-1")})
+        assert response.status_code == 403
+        assert "Invalid API key" in response.json()["detail"]
+
     def test_delete_nonexistent_file(self, client, temp_dirs, enable_api_key):
         response = client.delete("/nonexistent.png", headers={"Authorization": "Bearer test-key"})
         assert response.status_code == 404
@@ -508,3 +769,55 @@ class TestUploadAuth:
         )
         assert response.status_code == 403
         assert "Invalid API key" in response.json()["detail"]
+
+
+@pytest.fixture
+def reload_settings(monkeypatch):
+    """Reload the settings module with the given environment variables set."""
+    import importlib
+
+    import settings
+
+    def reload(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        return importlib.reload(settings)
+
+    yield reload
+    monkeypatch.undo()
+    importlib.reload(settings)
+
+
+class TestSettings:
+    def test_values_are_not_evaluated(self, reload_settings):
+        settings = reload_settings(API_KEY="__import__('os').getcwd()")
+        assert settings.API_KEY == "__import__('os').getcwd()"
+
+    def test_values_are_parsed_by_type(self, reload_settings):
+        settings = reload_settings(
+            ALLOW_VIDEO="false",
+            REQUIRE_API_KEY_FOR_UPLOAD="True",
+            MAX_SIZE_MB="32",
+            NUDE_FILTER_MAX_THRESHOLD="0.5",
+            VALID_SIZES="[100, 200]",
+            ALLOWED_ORIGINS="['https://a.com', 'https://b.com']",
+        )
+        assert settings.ALLOW_VIDEO is False
+        assert settings.REQUIRE_API_KEY_FOR_UPLOAD is True
+        assert settings.MAX_SIZE_MB == 32
+        assert settings.NUDE_FILTER_MAX_THRESHOLD == 0.5
+        assert settings.VALID_SIZES == [100, 200]
+        assert sorted(settings.VALID_SIZES_SET) == [100, 200]
+        assert settings.ALLOWED_ORIGINS == ["https://a.com", "https://b.com"]
+
+    def test_lists_accept_comma_separated_values(self, reload_settings):
+        settings = reload_settings(ALLOWED_ORIGINS="https://a.com, https://b.com")
+        assert settings.ALLOWED_ORIGINS == ["https://a.com", "https://b.com"]
+
+    def test_invalid_value_raises(self, reload_settings):
+        with pytest.raises(ValueError, match="MAX_SIZE_MB"):
+            reload_settings(MAX_SIZE_MB="lots")
+
+    def test_invalid_boolean_raises(self, reload_settings):
+        with pytest.raises(ValueError, match="REQUIRE_API_KEY_FOR_UPLOAD"):
+            reload_settings(REQUIRE_API_KEY_FOR_UPLOAD="Ture")
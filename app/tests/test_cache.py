@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+from cache import CacheIndex
+
+
+def write_file(directory, name: str, size: int, age: float = 0) -> str:
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(bytes(size))
+    if age:
+        then = time.time() - age
+        os.utime(path, (then, then))
+    return path
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path)
+
+
+class TestCacheIndex:
+    def test_add_evicts_least_recently_used(self, cache_dir):
+        index = CacheIndex(cache_dir, max_bytes=25)
+        first = write_file(cache_dir, "a_10x10.png", 10, age=300)
+        index.add(first)
+        second = write_file(cache_dir, "b_10x10.png", 10, age=200)
+        index.add(second)
+
+        # Using the first file makes the second one the eviction candidate
+        index.touch(first)
+        third = write_file(cache_dir, "c_10x10.png", 10)
+        evicted = index.add(third)
+
+        assert evicted == [second]
+        assert not os.path.exists(second)
+        assert os.path.exists(first)
+        assert os.path.exists(third)
+        assert index.total_bytes == 20
+
+    def test_existing_files_are_counted(self, cache_dir):
+        for age, name in enumerate(("c_10x10.png", "b_10x10.png", "a_10x10.png"), start=1):
+            write_file(cache_dir, name, 10, age=age * 100)
+        write_file(cache_dir, ".tmp-abc-d_10x10.png", 10)
+
+        index = CacheIndex(cache_dir, max_bytes=25)
+        assert index.total_bytes == 30
+
+        evicted = index.add(write_file(cache_dir, "e_10x10.png", 10))
+        assert evicted == [os.path.join(cache_dir, name) for name in ("a_10x10.png", "b_10x10.png")]
+        assert index.total_bytes == 20
+        assert os.path.exists(os.path.join(cache_dir, ".tmp-abc-d_10x10.png"))
+
+    def test_limit_is_shared_between_processes(self, cache_dir):
+        # Each worker process has its own index over the same directory
+        first_worker = CacheIndex(cache_dir, max_bytes=25)
+        second_worker = CacheIndex(cache_dir, max_bytes=25)
+        first = write_file(cache_dir, "a_10x10.png", 10, age=300)
+        first_worker.add(first)
+        second_worker.add(write_file(cache_dir, "b_10x10.png", 10, age=200))
+
+        assert first_worker.add(write_file(cache_dir, "c_10x10.png", 10)) == [first]
+        assert second_worker.total_bytes == 20
+
+    def test_most_recent_file_is_kept_over_limit(self, cache_dir):
+        index = CacheIndex(cache_dir, max_bytes=5)
+        path = write_file(cache_dir, "a_10x10.png", 10)
+
+        assert index.add(path) == []
+        assert os.path.exists(path)
+
+    def test_discard_recounts_files(self, cache_dir):
+        index = CacheIndex(cache_dir, max_bytes=100)
+        path = write_file(cache_dir, "a_10x10.png", 10)
+        index.add(path)
+        os.remove(path)
+
+        index.discard([path])
+        assert index.total_bytes == 0
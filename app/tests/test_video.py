@@ -1,5 +1,7 @@
 import os
+import shutil
 import tempfile
+import time
 
 import cv2
 import numpy as np
@@ -12,12 +14,12 @@ def create_test_video(filepath: str, duration_seconds: float, fps: int = 30, wid
     out = cv2.VideoWriter(filepath, fourcc, fps, (width, height))
 
     total_frames = int(duration_seconds * fps)
-    for i in range(total_frames):
-        # Create a frame with varying colors
-        frame = np.zeros((height, width, 3), dtype=np.uint8)
-        frame[:, :, 0] = (i * 3) % 256  # Blue channel
-        frame[:, :, 1] = (i * 5) % 256  # Green channel
-        frame[:, :, 2] = (i * 7) % 256  # Red channel
+    # Blue, green and red advance at different rates, all frame colors are computed up front
+    colors = ((np.arange(total_frames)[:, np.newaxis] * np.array([3, 5, 7])) & 0xFF).astype(np.uint8)
+    # VideoWriter copies the frame, so one buffer is reused
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    for color in colors:
+        frame[:] = color
         out.write(frame)
 
     out.release()
@@ -64,6 +66,54 @@ class TestGetVideoDuration:
         duration = video.get_video_duration("/nonexistent/file.mp4")
         assert duration == 0.0
 
+    def test_shortened_mp4_header_is_ignored(self, long_video):
+        import video
+
+        with open(long_video, "r+b") as f:
+            data = f.read()
+            # Version 0 mvhd: version and flags, creation and modification time, timescale, then duration
+            f.seek(data.index(b"mvhd") + 20)
+            f.write((1).to_bytes(4, "big"))
+        assert video.check_video_duration(long_video) is True
+        assert 89.0 <= video.get_video_duration(long_video) <= 91.0
+
+
+class TestProbeVideo:
+    def test_reads_metadata(self, short_video):
+        import video
+
+        info = video.probe_video(short_video)
+        assert info.fps == 30
+        assert info.frame_count == 60
+        assert 1.9 <= info.duration <= 2.1
+
+    def test_opens_video_once(self, short_video, monkeypatch):
+        import video
+
+        opened: list[str] = []
+        video_capture = cv2.VideoCapture
+
+        def counting_capture(filepath: str) -> cv2.VideoCapture:
+            opened.append(filepath)
+            return video_capture(filepath)
+
+        monkeypatch.setattr("video.cv2.VideoCapture", counting_capture)
+        assert video.check_video_duration(short_video) is False
+        assert 1.9 <= video.get_video_duration(short_video) <= 2.1
+        assert opened == [short_video]
+
+    def test_rewritten_file_is_probed_again(self, short_video):
+        import video
+
+        assert video.probe_video(short_video).frame_count == 60
+        create_test_video(short_video, duration_seconds=1.0, fps=30)
+        assert video.probe_video(short_video).frame_count == 30
+
+    def test_missing_file(self):
+        import video
+
+        assert video.probe_video("/nonexistent/file.mp4") == (0.0, 0, 0.0)
+
 
 class TestCheckVideoDuration:
     def test_short_video_passes(self, short_video):
@@ -81,35 +131,124 @@ class TestExtractVideoFrames:
     def test_extracts_frames_at_interval(self, short_video):
         import video
 
-        frames = video.extract_video_frames(short_video, interval=1.0)
+        frames = list(video.extract_video_frames(short_video, interval=1.0))
         try:
             # 2-second video at 1-second interval should yield ~2-3 frames
             assert 2 <= len(frames) <= 3
-            # Verify frames are actual files
+            # Verify frames are actual files sharing one directory
             for frame_path in frames:
                 assert os.path.exists(frame_path)
                 assert frame_path.endswith(".jpg")
+            assert len({os.path.dirname(frame_path) for frame_path in frames}) == 1
         finally:
-            for frame_path in frames:
-                if os.path.exists(frame_path):
-                    os.remove(frame_path)
+            if frames:
+                shutil.rmtree(os.path.dirname(frames[0]))
 
     def test_extracts_more_frames_with_shorter_interval(self, short_video):
         import video
 
-        frames = video.extract_video_frames(short_video, interval=0.5)
+        frames = list(video.extract_video_frames(short_video, interval=0.5))
         try:
             # 2-second video at 0.5-second interval should yield ~4-5 frames
             assert 4 <= len(frames) <= 5
         finally:
-            for frame_path in frames:
-                if os.path.exists(frame_path):
-                    os.remove(frame_path)
+            if frames:
+                shutil.rmtree(os.path.dirname(frames[0]))
+
+    def test_seeks_to_sampled_frames_over_long_gaps(self, long_video):
+        import video
+
+        frames = list(video.extract_video_frames(long_video, interval=10.0, max_frames=3))
+        try:
+            assert len(frames) == 3
+            # Frames encode their index in the blue channel, check each sample landed on the right one
+            for i, frame_path in enumerate(frames):
+                blue = int(cv2.imread(frame_path)[:, :, 0].mean())
+                assert abs(blue - (i * 100 * 3) % 256) <= 8
+        finally:
+            if frames:
+                shutil.rmtree(os.path.dirname(frames[0]))
+
+    def test_middle_first_order(self, long_video):
+        import video
+
+        frames = list(video.iter_video_frames(long_video, interval=10.0, middle_first=True))
+        # Samples are every 100 frames, blue is the frame index * 3
+        expected = [400, 300, 500, 200, 600, 100, 700, 0, 800]
+        assert len(frames) == len(expected)
+        for frame, index in zip(frames, expected):
+            assert abs(int(frame[:, :, 0].mean()) - (index * 3) % 256) <= 8
+
+    def test_middle_first_keeps_chunks_in_stream_order(self, long_video):
+        import video
+
+        expected_orders = {
+            # A single chunk is decoded in one forward pass
+            9: [0, 100, 200, 300, 400, 500, 600, 700, 800],
+            3: [300, 400, 500, 0, 100, 200, 600, 700, 800],
+            4: [400, 500, 600, 700, 0, 100, 200, 300, 800],
+            2: [400, 500, 200, 300, 600, 700, 0, 100, 800],
+        }
+        for chunk_size, expected in expected_orders.items():
+            frames = list(video.iter_video_frames(long_video, interval=10.0, middle_first=True, chunk_size=chunk_size))
+            assert len(frames) == len(expected)
+            for frame, index in zip(frames, expected):
+                assert abs(int(frame[:, :, 0].mean()) - (index * 3) % 256) <= 8
+
+    def test_hw_acceleration_falls_back_to_cpu(self, short_video, monkeypatch):
+        import video
+
+        monkeypatch.setattr("video.settings.VIDEO_HW_ACCELERATION", True)
+        frames = list(video.extract_video_frames(short_video, interval=1.0))
+        try:
+            assert 2 <= len(frames) <= 3
+        finally:
+            if frames:
+                shutil.rmtree(os.path.dirname(frames[0]))
+
+    def test_removes_directory_when_decoding_fails(self, monkeypatch):
+        import video
+
+        created: list[str] = []
+        mkdtemp = tempfile.mkdtemp
+
+        def recording_mkdtemp(**kwargs) -> str:
+            created.append(mkdtemp(**kwargs))
+            return created[-1]
+
+        def failing_frames(*args, **kwargs):
+            yield np.zeros((64, 64, 3), dtype=np.uint8)
+            raise ValueError("decode failed")
+
+        monkeypatch.setattr("video.tempfile.mkdtemp", recording_mkdtemp)
+        monkeypatch.setattr("video.iter_video_frames", failing_frames)
+        # The only frame fails to encode, so no path reaches the caller before decoding fails
+        monkeypatch.setattr("video.cv2.imwrite", lambda *args: False)
+        with pytest.raises(ValueError, match="decode failed"):
+            list(video.extract_video_frames("video.mp4", interval=1.0))
+        assert len(created) == 1
+        assert not os.path.exists(created[0])
+
+    def test_skips_frames_that_fail_to_encode(self, short_video, monkeypatch):
+        import video
+
+        created: list[str] = []
+        mkdtemp = tempfile.mkdtemp
+
+        def recording_mkdtemp(**kwargs) -> str:
+            created.append(mkdtemp(**kwargs))
+            return created[-1]
+
+        monkeypatch.setattr("video.tempfile.mkdtemp", recording_mkdtemp)
+        monkeypatch.setattr("video.cv2.imwrite", lambda *args: False)
+        assert list(video.extract_video_frames(short_video, interval=1.0)) == []
+        assert len(created) == 1
+        assert not os.path.exists(created[0])
 
     def test_returns_empty_list_for_invalid_file(self):
         import video
 
-        frames = video.extract_video_frames("/nonexistent/file.mp4", interval=1.0)
+        frames = list(video.extract_video_frames("/nonexistent/file.mp4", interval=1.0))
         assert frames == []
 
 
@@ -127,8 +266,8 @@ class TestCheckVideoNudityFilter:
 
         # Mock the classifier to return safe values for batch classification
         class MockClassifier:
-            def classify(self, filepaths: list[str]) -> dict[str, dict[str, float]]:
-                return {fp: {"unsafe": 0.1} for fp in filepaths}
+            def classify(self, images: list[np.ndarray], batch_size: int = 4) -> dict[int, dict[str, float]]:
+                return {i: {"unsafe": 0.1} for i in range(len(images))}
 
         monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_THRESHOLD", 0.5)
         monkeypatch.setattr("video.imgpush.nude_classifier", MockClassifier())
@@ -141,8 +280,8 @@ class TestCheckVideoNudityFilter:
 
         # Mock the classifier to return unsafe values for batch classification
         class MockClassifier:
-            def classify(self, filepaths: list[str]) -> dict[str, dict[str, float]]:
-                return {fp: {"unsafe": 0.9} for fp in filepaths}
+            def classify(self, images: list[np.ndarray], batch_size: int = 4) -> dict[int, dict[str, float]]:
+                return {i: {"unsafe": 0.9} for i in range(len(images))}
 
         monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_THRESHOLD", 0.5)
         monkeypatch.setattr("video.imgpush.nude_classifier", MockClassifier())
@@ -150,29 +289,109 @@ class TestCheckVideoNudityFilter:
         result = video.check_video_nudity_filter(short_video)
         assert result is True
 
-    def test_cleans_up_temp_frames(self, short_video, monkeypatch):
+    def test_classifies_frames_in_memory(self, short_video, monkeypatch):
         import video
 
-        extracted_frames: list[str] = []
+        classified: list[np.ndarray] = []
 
-        original_extract = video.extract_video_frames
+        class MockClassifier:
+            def classify(self, images: list[np.ndarray], batch_size: int = 4) -> dict[int, dict[str, float]]:
+                classified.extend(images)
+                return {i: {"unsafe": 0.1} for i in range(len(images))}
 
-        def tracking_extract(filepath: str, interval: float, max_frames: int = 0) -> list[str]:
-            frames = original_extract(filepath, interval, max_frames)
-            extracted_frames.extend(frames)
-            return frames
+        def no_disk(*args, **kwargs):
+            raise AssertionError("frames should not be written to disk")
+
+        monkeypatch.setattr("video.tempfile.mkdtemp", no_disk)
+        monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_THRESHOLD", 0.5)
+        monkeypatch.setattr("video.imgpush.nude_classifier", MockClassifier())
+
+        assert video.check_video_nudity_filter(short_video) is False
+        assert classified
+        for image in classified:
+            assert image.dtype == np.uint8
+            assert image.shape == (256, 256, 3)
+
+    def test_stops_at_first_unsafe_batch(self, short_video, monkeypatch):
+        import video
+
+        batches: list[int] = []
 
-        # Mock the classifier to return safe values for batch classification
         class MockClassifier:
-            def classify(self, filepaths: list[str]) -> dict[str, dict[str, float]]:
-                return {fp: {"unsafe": 0.1} for fp in filepaths}
+            def classify(self, images: list[np.ndarray], batch_size: int = 4) -> dict[int, dict[str, float]]:
+                batches.append(len(images))
+                return {i: {"unsafe": 0.9} for i in range(len(images))}
+
+        monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_THRESHOLD", 0.5)
+        monkeypatch.setattr("video.settings.NUDE_FILTER_VIDEO_INTERVAL", 0.25)
+        monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_FRAMES", 0)
+        monkeypatch.setattr("video.settings.NUDE_FILTER_BATCH_SIZE", 3)
+        monkeypatch.setattr("video.imgpush.nude_classifier", MockClassifier())
+
+        assert video.check_video_nudity_filter(short_video) is True
+        assert batches == [3]
+
+    def test_decodes_next_batch_while_classifying(self, monkeypatch):
+        import video
+
+        decoded: list[int] = []
+        ahead: list[int] = []
 
-        monkeypatch.setattr("video.extract_video_frames", tracking_extract)
+        def fake_frames(*args, **kwargs):
+            for i in range(12):
+                decoded.append(i)
+                yield np.zeros((256, 256, 3), dtype=np.uint8)
+
+        class MockClassifier:
+            def classify(self, images: list[np.ndarray], batch_size: int = 4) -> dict[int, dict[str, float]]:
+                if not ahead:
+                    # Give the decoder thread time to fill the next batch
+                    deadline = time.monotonic() + 5
+                    while len(decoded) < 6 and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                ahead.append(len(decoded))
+                return {i: {"unsafe": 0.1} for i in range(len(images))}
+
+        monkeypatch.setattr("video.iter_video_frames", fake_frames)
         monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_THRESHOLD", 0.5)
+        monkeypatch.setattr("video.settings.NUDE_FILTER_MAX_FRAMES", 0)
+        monkeypatch.setattr("video.settings.NUDE_FILTER_BATCH_SIZE", 3)
         monkeypatch.setattr("video.imgpush.nude_classifier", MockClassifier())
 
-        video.check_video_nudity_filter(short_video)
+        assert video.check_video_nudity_filter("video.mp4") is False
+        assert len(ahead) == 4
+        assert ahead[0] >= 6
+
+
+class TestPrefetch:
+    def test_yields_all_items_in_order(self):
+        import video
+
+        with video.prefetch(iter(range(10)), maxsize=2) as items:
+            assert list(items) == list(range(10))
+
+    def test_reraises_producer_errors(self):
+        import video
+
+        def failing():
+            yield 1
+            raise ValueError("decode failed")
+
+        with video.prefetch(failing(), maxsize=2) as items, pytest.raises(ValueError, match="decode failed"):
+            list(items)
+
+    def test_leaving_early_closes_items(self):
+        import video
+
+        closed = []
+
+        def endless():
+            try:
+                while True:
+                    yield 1
+            finally:
+                closed.append(True)
 
-        # Verify all temp frames were cleaned up
-        for frame_path in extracted_frames:
-            assert not os.path.exists(frame_path)
+        with video.prefetch(endless(), maxsize=2) as items:
+            assert next(items) == 1
+        assert closed == [True]
@@ -1,23 +1,73 @@
 import contextlib
+import functools
+import itertools
 import os
+import queue
+import shutil
 import tempfile
+import threading
+from collections.abc import Generator, Iterator
+from typing import NamedTuple, Optional, TypeVar, cast
 
 import cv2
 import imgpush
 import settings
+from cv2.typing import MatLike
 
+T = TypeVar("T")
 
-def get_video_duration(filepath: str) -> float:
-    """Get video duration in seconds."""
+# Gaps between sampled frames longer than this are seeked over instead of grabbed through.
+# A seek still decodes forwards from the preceding keyframe to the exact frame, so it only saves work
+# once the gap is longer than a GOP, the run of frames between two keyframes.
+SEEK_GAP_SECONDS = 2.0
+
+# Input size of nudenet's classifier, sampled frames are resized to it once while decoding
+CLASSIFIER_INPUT_SIZE = (256, 256)
+
+# Extracted frames only feed the classifier at its input size, so a lower JPEG quality loses nothing that matters
+_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 70]
+
+
+def open_video(filepath: str) -> cv2.VideoCapture:
+    """Open filepath for decoding, on the GPU if VIDEO_HW_ACCELERATION is set and a device is available."""
+    if settings.VIDEO_HW_ACCELERATION:
+        return cv2.VideoCapture(filepath, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    return cv2.VideoCapture(filepath)
+
+
+class VideoInfo(NamedTuple):
+    fps: float
+    frame_count: int
+    duration: float
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_video(filepath: str, mtime_ns: int, size: int) -> VideoInfo:
     cap = cv2.VideoCapture(filepath)
     try:
         fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        if fps <= 0:
-            return 0.0
-        return frame_count / fps
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     finally:
         cap.release()
+    return VideoInfo(fps, frame_count, frame_count / fps if fps > 0 else 0.0)
+
+
+def probe_video(filepath: str) -> VideoInfo:
+    """Read a video's frame rate, frame count and duration in seconds, all zero if it can't be read.
+
+    The duration is counted from the frames, never taken from a container header the uploader could have edited.
+    Results are cached per file version, so checking the same upload several times only opens it once.
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return VideoInfo(0.0, 0, 0.0)
+    return _probe_video(filepath, stat.st_mtime_ns, stat.st_size)
+
+
+def get_video_duration(filepath: str) -> float:
+    """Get video duration in seconds."""
+    return probe_video(filepath).duration
 
 
 def check_video_duration(filepath: str) -> bool:
@@ -29,26 +79,33 @@ def check_video_duration(filepath: str) -> bool:
     return duration > settings.MAX_VIDEO_DURATION
 
 
-def extract_video_frames(filepath: str, interval: float, max_frames: int = 0) -> list[str]:
-    """Extract frames from video at specified interval in seconds.
+def iter_video_frames(
+    filepath: str,
+    interval: float,
+    max_frames: int = 0,
+    size: Optional[tuple[int, int]] = CLASSIFIER_INPUT_SIZE,
+    middle_first: bool = False,
+    chunk_size: int = 1,
+) -> Generator[MatLike, None, None]:
+    """Decode frames from video at specified interval in seconds.
 
-    Returns list of temporary file paths containing extracted frames.
-    Caller is responsible for cleaning up these files.
+    Yields the frames as BGR images resized to size, by default the classifier's input size.
 
     Args:
         filepath: Path to video file.
         interval: Interval in seconds between extracted frames.
         max_frames: Maximum number of frames to extract. 0 means no limit.
+        size: (width, height) to resize frames to. None scales them down to at most 480px on their longest side.
+        middle_first: Yield frames from the middle of the video outwards instead of from the start.
+        chunk_size: With middle_first, reorder chunks of this many consecutive frames, each decoded in stream order.
     """
-    frame_paths: list[str] = []
-    cap = cv2.VideoCapture(filepath)
+    fps, total_frames, _ = probe_video(filepath)
+    if fps <= 0 or total_frames <= 0:
+        return
 
-    try:
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        if fps <= 0 or total_frames <= 0:
-            return frame_paths
+    cap = open_video(filepath)
 
+    try:
         frame_interval = int(fps * interval)
         if frame_interval < 1:
             frame_interval = 1
@@ -57,28 +114,129 @@ def extract_video_frames(filepath: str, interval: float, max_frames: int = 0) ->
         target_frames = list(range(0, total_frames, frame_interval))
         if max_frames > 0:
             target_frames = target_frames[:max_frames]
+        if middle_first:
+            # Only moving between chunks seeks, within a chunk the stream is walked forwards.
+            # The last chunk, the only one that can be short, always comes last.
+            chunk_size = max(chunk_size, 1)
+            chunks = [target_frames[i : i + chunk_size] for i in range(0, len(target_frames), chunk_size)]
+            middle = (len(chunks) - 1) // 2
+            order = sorted(range(len(chunks)), key=lambda i: abs(i - middle))
+            target_frames = [target for i in order for target in chunks[i]]
 
-        # Seek directly to each target frame instead of reading every frame
-        for frame_num in target_frames:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-            ret, frame = cap.read()
+        # Walk the stream forwards: grab() advances past frames without converting them,
+        # only the sampled frames are retrieved as BGR images. Long gaps and going back are seeked.
+        seek_gap = fps * SEEK_GAP_SECONDS
+        frame_num = 0
+        for target in target_frames:
+            if target < frame_num or target - frame_num > seek_gap:
+                cap.set(cv2.CAP_PROP_POS_MSEC, target / fps * 1000)
+                # The FFmpeg backend seeks to the exact frame, reading the position back is only a safety check
+                frame_num = max(int(cap.get(cv2.CAP_PROP_POS_FRAMES)), 0)
+            while frame_num < target and cap.grab():
+                frame_num += 1
+            # Ran out of frames, the frame count in the header can be an overestimate
+            if frame_num < target or not cap.grab():
+                continue
+            frame_num += 1
+            ret, frame = cap.retrieve()
             if not ret:
                 continue
 
-            # Resize to max 480px on longest side for memory efficiency
             h, w = frame.shape[:2]
-            if max(h, w) > 480:
+            if size is not None:
+                # The classifier resizes to its input size anyway, area interpolation keeps detail a plain resize drops
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            elif max(h, w) > 480:
+                # Resize to max 480px on longest side for memory efficiency
                 scale = 480 / max(h, w)
                 frame = cv2.resize(frame, (int(w * scale), int(h * scale)))
 
-            fd, temp_path = tempfile.mkstemp(suffix=".jpg")
-            os.close(fd)
-            cv2.imwrite(temp_path, frame)
-            frame_paths.append(temp_path)
+            yield frame
     finally:
         cap.release()
 
-    return frame_paths
+
+def extract_video_frames(
+    filepath: str, interval: float, max_frames: int = 0, size: Optional[tuple[int, int]] = CLASSIFIER_INPUT_SIZE
+) -> Iterator[str]:
+    """Extract frames from video at specified interval in seconds, like iter_video_frames.
+
+    Yields temporary file paths of the extracted frames as they are written, all in one temporary directory.
+    Caller is responsible for cleaning up, e.g. with shutil.rmtree(os.path.dirname(frame_path)).
+    """
+    frames_dir = ""
+    yielded = False
+    try:
+        for count, frame in enumerate(iter_video_frames(filepath, interval, max_frames, size)):
+            if not frames_dir:
+                frames_dir = tempfile.mkdtemp(prefix="frames-")
+            frame_path = os.path.join(frames_dir, f"{count:04d}.jpg")
+            # Frames that failed to encode are skipped
+            if cv2.imwrite(frame_path, frame, _JPEG_PARAMS):
+                yielded = True
+                yield frame_path
+    finally:
+        # Until a path is yielded the caller doesn't know the directory, so it can't clean it up
+        if frames_dir and not yielded:
+            shutil.rmtree(frames_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def prefetch(items: Iterator[T], maxsize: int) -> Iterator[Iterator[T]]:
+    """Consume items in a background thread, up to maxsize ahead of the caller.
+
+    Leaving the context stops the thread and closes items.
+    """
+    buffer: queue.Queue[tuple[bool, object]] = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(done: bool, value: object) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put((done, value), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(False, item):
+                    return
+            put(True, None)
+        except BaseException as e:
+            put(True, e)
+        finally:
+            # Runs the generator's cleanup, such as releasing the capture, in this thread
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+
+    def consume() -> Iterator[T]:
+        while True:
+            done, value = buffer.get()
+            if done:
+                if isinstance(value, BaseException):
+                    raise value
+                return
+            yield cast(T, value)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        yield consume()
+    finally:
+        stop.set()
+        thread.join()
+
+
+def is_unsafe_batch(frames: list[MatLike]) -> bool:
+    """Classify frames with nudenet, True if any of them exceeds NUDE_FILTER_MAX_THRESHOLD."""
+    if not settings.NUDE_FILTER_MAX_THRESHOLD or imgpush.nude_classifier is None:
+        return False
+    result = imgpush.nude_classifier.classify(frames, batch_size=len(frames))
+    return any(scores.get("unsafe", 0) >= settings.NUDE_FILTER_MAX_THRESHOLD for scores in result.values())
 
 
 def check_video_nudity_filter(filepath: str) -> bool:
@@ -99,20 +257,20 @@ def check_video_nudity_filter(filepath: str) -> bool:
             min_interval_for_coverage = duration / max_frames
             interval = max(interval, min_interval_for_coverage)
 
-    frame_paths = extract_video_frames(filepath, interval, max_frames)
+    batch_size = max(settings.NUDE_FILTER_BATCH_SIZE, 1)
 
-    if not frame_paths:
-        return False
+    def decode_batches() -> Iterator[list[MatLike]]:
+        # Frames from the middle of a video are the likeliest to show nudity, classify those first so unsafe
+        # videos are usually rejected after the first batch. Only whole batches are reordered, so a video that
+        # fits in one batch is decoded in a single forward pass.
+        frames_iter = iter_video_frames(filepath, interval, max_frames, middle_first=True, chunk_size=batch_size)
+        with contextlib.closing(frames_iter) as frames:
+            for batch in itertools.batched(frames, batch_size):
+                yield list(batch)
 
-    try:
-        # Classify frames one at a time to avoid memory spikes
-        for frame_path in frame_paths:
-            result = imgpush.nude_classifier.classify([frame_path])
-            unsafe_val = result.get(frame_path, {}).get("unsafe", 0)
-            if unsafe_val >= settings.NUDE_FILTER_MAX_THRESHOLD:
-                return True
-        return False
-    finally:
-        for frame_path in frame_paths:
-            with contextlib.suppress(OSError):
-                os.remove(frame_path)
+    # Frames are classified straight from memory, nudenet accepts BGR arrays as well as paths.
+    # Whole batches are decoded in a background thread: one waits ready and the next is being decoded
+    # while the current batch is classified.
+    with prefetch(decode_batches(), maxsize=1) as batches:
+        # Returning early also stops the decoder thread
+        return any(is_unsafe_batch(batch) for batch in batches)
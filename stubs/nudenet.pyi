@@ -2,7 +2,11 @@
 
 from typing import overload
 
+from cv2.typing import MatLike
+from onnxruntime import InferenceSession
+
 class NudeClassifier:
+    nsfw_model: InferenceSession
     def __init__(self) -> None: ...
     @overload
     def classify(
@@ -22,3 +26,12 @@ class NudeClassifier:
         image_size: tuple[int, int] = (256, 256),
         categories: list[str] = ...,
     ) -> dict[str, dict[str, float]]: ...
+    @overload
+    def classify(
+        self,
+        image_paths: list[MatLike],
+        *,
+        batch_size: int = 4,
+        image_size: tuple[int, int] = (256, 256),
+        categories: list[str] = ...,
+    ) -> dict[int, dict[str, float]]: ...
@@ -0,0 +1,17 @@
+"""Type stubs for onnxruntime library."""
+
+from collections.abc import Sequence
+
+class NodeArg:
+    @property
+    def name(self) -> str: ...
+    @property
+    def shape(self) -> list[int | str | None]: ...
+
+class InferenceSession:
+    def __init__(
+        self, path_or_bytes: str | bytes, providers: Sequence[str | tuple[str, dict[str, object]]] | None = None
+    ) -> None: ...
+    def get_inputs(self) -> list[NodeArg]: ...
+
+def get_available_providers() -> list[str]: ...
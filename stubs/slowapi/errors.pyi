@@ -1,3 +0,0 @@
-class RateLimitExceeded(Exception):
-    detail: str
-    def __init__(self, detail: str = "Rate limit exceeded") -> None: ...